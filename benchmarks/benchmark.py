@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Benchmark y prueba de carga del backend con un nuclei falso.
+
+Levanta uvicorn con NUCLEI_PATH apuntando a fake_nuclei.py y una base de
+datos temporal, lanza peticiones concurrentes contra /scan-json, /history y
+/scan-pdf y escribe un JSON con latencias (p50/p95/p99), peticiones por
+segundo, pico de RSS y número de subprocesos de nuclei.
+
+Uso (desde la raíz del repo):
+
+    python benchmarks/benchmark.py --requests 200 --concurrency 20 \\
+        --findings 50 --delay 0.005 --output bench.json
+
+Solo usa la librería estándar y no necesita red.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_NUCLEI = os.path.join(REPO_DIR, "benchmarks", "fake_nuclei.py")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _procesos() -> dict[int, tuple[int, int, str]]:
+    # pid -> (ppid, rss_bytes, cmdline) leyendo /proc
+    procesos = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                campos = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode(errors="replace")
+        except OSError:
+            continue
+        # campos[1] = ppid, campos[21] = rss en páginas
+        procesos[int(pid)] = (int(campos[1]), int(campos[21]) * PAGE_SIZE, cmdline)
+    return procesos
+
+class Monitor(threading.Thread):
+    """Muestrea el árbol de procesos del servidor: RSS total y subprocesos
+    de nuclei vivos."""
+
+    def __init__(self, pid: int, intervalo: float = 0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervalo = intervalo
+        self.peak_rss = 0
+        self.peak_server_rss = 0
+        self.peak_nuclei = 0
+        self._detener = threading.Event()
+
+    def run(self):
+        while not self._detener.is_set():
+            procesos = _procesos()
+            arbol = {self.pid}
+            cambio = True
+            while cambio:
+                cambio = False
+                for pid, (ppid, _, _) in procesos.items():
+                    if ppid in arbol and pid not in arbol:
+                        arbol.add(pid)
+                        cambio = True
+            rss = sum(procesos[pid][1] for pid in arbol if pid in procesos)
+            lanzados = {pid for pid in arbol if pid in procesos and FAKE_NUCLEI in procesos[pid][2]}
+            # Un lanzador intermedio (p. ej. el shim de pyenv) crea una cadena
+            # de procesos con la misma línea de comandos: se cuenta solo la raíz
+            nuclei = sum(1 for pid in lanzados if procesos[pid][0] not in lanzados)
+            self.peak_rss = max(self.peak_rss, rss)
+            if self.pid in procesos:
+                self.peak_server_rss = max(self.peak_server_rss, procesos[self.pid][1])
+            self.peak_nuclei = max(self.peak_nuclei, nuclei)
+            self._detener.wait(self.intervalo)
+
+    def stop(self):
+        self._detener.set()
+        self.join()
+
+def _peticion(port: int, method: str, path: str, body: dict | None) -> tuple[float, int]:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    payload = json.dumps(body) if body is not None else None
+    inicio = time.perf_counter()
+    try:
+        conn.request(method, path, body=payload, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        status = response.status
+        # /scan-json responde 200 con {"status": "error"} cuando falla
+        if response.getheader("content-type", "").startswith("application/json"):
+            try:
+                if isinstance(cuerpo := json.loads(data), dict) and cuerpo.get("status") == "error":
+                    status = 500
+            except ValueError:
+                pass
+    except OSError:
+        status = 0
+    finally:
+        conn.close()
+    return time.perf_counter() - inicio, status
+
+def _percentil(valores: list[float], p: float) -> float:
+    # Método nearest-rank
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[k]
+
+def medir(port: int, method: str, path: str, cuerpos, total: int, concurrencia: int) -> dict:
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as pool:
+        resultados = list(pool.map(
+            lambda i: _peticion(port, method, path, cuerpos(i)), range(total)
+        ))
+    duracion = time.perf_counter() - inicio
+    latencias = [lat for lat, status in resultados if 200 <= status < 300]
+    return {
+        "requests": total,
+        "errors": total - len(latencias),
+        "duration_s": round(duracion, 4),
+        "rps": round(total / duracion, 2) if duracion else 0.0,
+        "latency_ms": {
+            "p50": round(_percentil(latencias, 50) * 1000, 2),
+            "p95": round(_percentil(latencias, 95) * 1000, 2),
+            "p99": round(_percentil(latencias, 99) * 1000, 2),
+            "max": round(max(latencias, default=0) * 1000, 2),
+            "mean": round(sum(latencias) / len(latencias) * 1000, 2) if latencias else 0.0
+        }
+    }
+
+def _esperar_servidor(port: int, proceso: subprocess.Popen, timeout: float = 30):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError("uvicorn terminó antes de arrancar")
+        try:
+            _, status = _peticion(port, "GET", "/history?limit=1", None)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("uvicorn no respondió a tiempo")
+
+def _leer_argumentos():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=100, help="peticiones por endpoint")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--endpoints", default="scan-json,history,scan-pdf")
+    parser.add_argument("--findings", type=int, default=20, help="hallazgos por escaneo")
+    parser.add_argument("--delay", type=float, default=0.01, help="segundos entre hallazgos")
+    parser.add_argument("--startup", type=float, default=0.0, help="arranque simulado de nuclei")
+    parser.add_argument("--malformed", type=float, default=0.1, help="proporción de líneas corruptas")
+    parser.add_argument("--sample", help="JSONL con hallazgos reales de nuclei")
+    parser.add_argument("--pdf-rows", type=int, default=200, help="filas enviadas a /scan-pdf")
+    parser.add_argument("--use-cache", action="store_true", help="no forzar escaneos nuevos")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto stdout)")
+    return parser.parse_args()
+
+def main() -> int:
+    args = _leer_argumentos()
+    port = _puerto_libre()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        contador = os.path.join(tmp, "nuclei_spawns.txt")
+        env = {
+            **os.environ,
+            "NUCLEI_PATH": FAKE_NUCLEI,
+            "DATABASE_FILE": os.path.join(tmp, "bench.db"),
+            "FAKE_NUCLEI_FINDINGS": str(args.findings),
+            "FAKE_NUCLEI_DELAY": str(args.delay),
+            "FAKE_NUCLEI_STARTUP": str(args.startup),
+            "FAKE_NUCLEI_MALFORMED": str(args.malformed),
+            "FAKE_NUCLEI_COUNTER": contador,
+        }
+        if args.sample:
+            env["FAKE_NUCLEI_SAMPLE"] = os.path.abspath(args.sample)
+
+        servidor = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+             "--port", str(port), "--log-level", "warning"],
+            cwd=REPO_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        monitor = Monitor(servidor.pid)
+        try:
+            _esperar_servidor(port, servidor)
+            monitor.start()
+
+            filas_pdf = [
+                {"severity": "high", "name": f"Hallazgo {i}", "matchedAt": f"http://bench.local/{i}"}
+                for i in range(args.pdf_rows)
+            ]
+            escenarios = {
+                "scan-json": ("POST", "/scan-json", lambda i: {
+                    "url": f"http://bench-{i}.local", "force": not args.use_cache
+                }),
+                "history": ("GET", "/history", lambda i: None),
+                "scan-pdf": ("POST", "/scan-pdf", lambda i: {
+                    "url": f"http://bench-{i}.local", "vulnerabilities": filas_pdf
+                }),
+            }
+
+            resultados = {}
+            for nombre in args.endpoints.split(","):
+                method, path, cuerpos = escenarios[nombre.strip()]
+                resultados[nombre] = medir(port, method, path, cuerpos, args.requests, args.concurrency)
+        finally:
+            if monitor.is_alive():
+                monitor.stop()
+            servidor.terminate()
+            servidor.wait(timeout=30)
+
+        spawns = 0
+        if os.path.exists(contador):
+            with open(contador) as f:
+                spawns = sum(1 for _ in f)
+
+    reporte = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": vars(args),
+        "results": resultados,
+        "server": {
+            "peak_rss_bytes": monitor.peak_rss,
+            "peak_server_rss_bytes": monitor.peak_server_rss,
+            "peak_nuclei_processes": monitor.peak_nuclei,
+            "nuclei_spawned": spawns
+        }
+    }
+    salida = json.dumps(reporte, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(salida + "\n")
+    else:
+        print(salida)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
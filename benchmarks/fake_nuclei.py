@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Sustituto de nuclei para benchmarks: emite hallazgos JSONL sintéticos
+sin tocar la red. Se configura con variables de entorno:
+
+    FAKE_NUCLEI_FINDINGS   hallazgos por objetivo (por defecto 20)
+    FAKE_NUCLEI_DELAY      segundos entre hallazgos (por defecto 0.01)
+    FAKE_NUCLEI_STARTUP    segundos de arranque simulado (por defecto 0)
+    FAKE_NUCLEI_MALFORMED  proporción de líneas corruptas, 0-1 (por defecto 0.1)
+    FAKE_NUCLEI_SAMPLE     archivo JSONL con hallazgos reales de nuclei a reutilizar
+    FAKE_NUCLEI_COUNTER    archivo al que se añade una línea por ejecución
+"""
+import json
+import os
+import random
+import sys
+import time
+
+SEVERIDADES = ["info", "low", "medium", "high", "critical"]
+
+def _arg(nombre: str) -> str | None:
+    if nombre in sys.argv:
+        i = sys.argv.index(nombre)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return None
+
+def _cargar_muestra(path: str | None) -> list[dict]:
+    # Solo se usan las líneas que parecen salida de nuclei
+    if not path or not os.path.exists(path):
+        return []
+    muestra = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                v = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(v, dict) and "template-id" in v:
+                muestra.append(v)
+    return muestra
+
+def _hallazgo(target: str, i: int, muestra: list[dict]) -> dict:
+    if muestra:
+        v = dict(muestra[i % len(muestra)])
+        template_id = f"{v['template-id']}-{i}"
+    else:
+        template_id = f"fake-template-{i}"
+        v = {
+            "info": {
+                "name": f"Hallazgo sintético {i}",
+                "severity": SEVERIDADES[i % len(SEVERIDADES)],
+                "description": "Generado por fake_nuclei.py",
+                "reference": ["https://example.com/fake"]
+            },
+            "type": "http"
+        }
+    v["template-id"] = template_id
+    v["host"] = target
+    v["url"] = target
+    v["matched-at"] = f"{target.rstrip('/')}/fake/{i}"
+    return v
+
+def main() -> int:
+    if "-version" in sys.argv:
+        print("Nuclei Engine Version: v3.0.0-fake", file=sys.stderr)
+        return 0
+
+    contador = os.environ.get("FAKE_NUCLEI_COUNTER")
+    if contador:
+        with open(contador, "a") as f:
+            f.write(f"{os.getpid()}\n")
+
+    hallazgos = int(os.environ.get("FAKE_NUCLEI_FINDINGS", "20"))
+    delay = float(os.environ.get("FAKE_NUCLEI_DELAY", "0.01"))
+    malformadas = float(os.environ.get("FAKE_NUCLEI_MALFORMED", "0.1"))
+    muestra = _cargar_muestra(os.environ.get("FAKE_NUCLEI_SAMPLE"))
+    rng = random.Random(0)
+
+    if _arg("-u"):
+        targets = [_arg("-u")]
+    elif _arg("-l"):
+        with open(_arg("-l"), encoding="utf-8") as f:
+            targets = [line.strip() for line in f if line.strip()]
+    else:
+        print("[FTL] no se indicó objetivo (-u / -l)", file=sys.stderr)
+        return 1
+    ids = set(_arg("-id").split(",")) if _arg("-id") else None
+
+    print("[INF] fake nuclei: " + " ".join(sys.argv[1:]), file=sys.stderr)
+    time.sleep(float(os.environ.get("FAKE_NUCLEI_STARTUP", "0")))
+
+    for target in targets:
+        for i in range(hallazgos):
+            v = _hallazgo(target, i, muestra)
+            if ids is not None and v["template-id"] not in ids:
+                continue
+            if rng.random() < malformadas:
+                sys.stdout.write('{"template-id": "roto", \n')
+            sys.stdout.write(json.dumps(v) + "\n")
+            sys.stdout.flush()
+            if delay:
+                time.sleep(delay)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,123 @@
 import os
 import json
 import asyncio
+import base64
+import hashlib
+import html
+import multiprocessing
+import re
 import shutil
 import tempfile
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 from typing import List, Any
+from urllib.parse import urlsplit, urlunsplit
 
 # --- IMPORTACIONES DE BASE DE DATOS Y PDF ---
-from sqlmodel import Field, Session, SQLModel, create_engine, select
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from sqlalchemy import Index, and_, event, func, insert, inspect, or_, text, update
+from sqlmodel import Field, Session, SQLModel, create_engine, delete, select
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fpdf import FPDF
 
 # --- 1. CONFIGURACIÓN DE BASE DE DATOS ---
 class ScanHistory(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_scanhistory_url_scan_date", "url", "scan_date"),
+        Index("ix_scanhistory_scan_date_id", "scan_date", "id"),
+    )
     id: int | None = Field(default=None, primary_key=True)
     url: str
     scan_date: datetime = Field(default_factory=datetime.utcnow)
     vulnerabilities_count: int
+    # Selección de plantillas del escaneo ("" = plantillas por defecto);
+    # los diffs solo comparan escaneos con la misma selección
+    templates: str = ""
+
+class Finding(SQLModel, table=True):
+    # url y scan_date se copian del escaneo para filtrar y agregar sin JOIN
+    __table_args__ = (
+        Index("ix_finding_url_scan_date", "url", "scan_date"),
+        Index("ix_finding_scan_date_severity", "scan_date", "severity"),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    scan_id: int = Field(foreign_key="scanhistory.id", index=True)
+    url: str
+    scan_date: datetime
+    template_id: str | None = Field(default=None, index=True)
+    severity: str | None = Field(default=None, index=True)
+    name: str | None = None
+    matched_at: str | None = None
+    description: str | None = None
+    reference: str = "[]"  # JSON con la lista de referencias
+
+class ScanJob(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    url: str
+    status: str = Field(default="queued", index=True)  # queued | running | done | error | cancelled
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    vulnerabilities_count: int | None = None
+    result: str | None = None  # JSON con la lista de hallazgos
+    error: str | None = None
+    force: bool = False
+    profile: str | None = None
+    tags: str = ""        # separados por comas
+    severities: str = ""  # separadas por comas
+
+class TemplateIndex(SQLModel, table=True):
+    # Metadatos de cada plantilla de nuclei-templates/, para elegir
+    # subconjuntos sin recorrer el árbol YAML en cada escaneo
+    path: str = Field(primary_key=True)
+    template_id: str = Field(index=True)
+    name: str | None = None
+    severity: str | None = Field(default=None, index=True)
+    protocol: str | None = Field(default=None, index=True)
+    author: str | None = None
+    mtime: float
+
+class TemplateTag(SQLModel, table=True):
+    path: str = Field(foreign_key="templateindex.path", primary_key=True)
+    tag: str = Field(primary_key=True, index=True)
+
+class ScanCache(SQLModel, table=True):
+    key: str = Field(primary_key=True)  # sha256(url normalizada + versión + plantillas)
+    url: str
+    nuclei_version: str
+    templates: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_access: datetime = Field(default_factory=datetime.utcnow, index=True)
+    size: int
+    vulnerabilities_count: int
+    result: str
 
-sqlite_file_name = "database.db"
+sqlite_file_name = os.environ.get("DATABASE_FILE", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
-engine = create_engine(sqlite_url)
+engine = create_engine(
+    sqlite_url,
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=int(os.environ.get("SQLITE_POOL_SIZE", "5")),
+    max_overflow=int(os.environ.get("SQLITE_POOL_OVERFLOW", "10")),
+)
+
+@event.listens_for(engine, "connect")
+def _configurar_sqlite(dbapi_connection, _):
+    # WAL permite leer el historial mientras los workers escriben
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 # --- 2. CONFIGURACIÓN DE LA APP ---
 app = FastAPI()
@@ -32,20 +126,260 @@ app = FastAPI()
 @app.on_event("startup")
 def on_startup():
     SQLModel.metadata.create_all(engine)
+    # create_all no añade columnas ni índices nuevos a tablas que ya existían
+    columnas = {c["name"] for c in inspect(engine).get_columns("scanhistory")}
+    if "templates" not in columnas:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE scanhistory ADD COLUMN templates VARCHAR NOT NULL DEFAULT ''"))
+    for index in ScanHistory.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+NUCLEI_PATH = os.environ.get("NUCLEI_PATH") or shutil.which("nuclei") or "/usr/local/bin/nuclei" 
+# Tamaño máximo de una línea JSONL de nuclei (incluye request/response completos)
+NUCLEI_MAX_LINEA = 16 * 1024 * 1024
+STDERR_MAX_LINEAS = 200
+# Líneas finales de stderr incluidas en el error cuando nuclei falla
+NUCLEI_ERROR_LINEAS = 10
+# Cola de trabajos: número de workers y máximo de trabajos en espera
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", "2"))
+SCAN_QUEUE_MAX = int(os.environ.get("SCAN_QUEUE_MAX", "100"))
+# Límite global de subprocesos de nuclei simultáneos: cubre la cola y
+# también los endpoints que escanean directamente (/scan-json, /scan-stream,
+# /scan-batch, /scan-diff)
+NUCLEI_MAX_PROCESOS = int(os.environ.get("NUCLEI_MAX_PROCESOS", "4"))
+# Caché de resultados: vigencia en segundos y límites de tamaño (LRU)
+SCAN_CACHE_TTL = int(os.environ.get("SCAN_CACHE_TTL", "3600"))
+SCAN_CACHE_MAX_ENTRIES = int(os.environ.get("SCAN_CACHE_MAX_ENTRIES", "1000"))
+SCAN_CACHE_MAX_BYTES = int(os.environ.get("SCAN_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+# Plantillas locales indexadas para los perfiles de escaneo
+NUCLEI_TEMPLATES_DIR = os.environ.get(
+    "NUCLEI_TEMPLATES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nuclei-templates")
+)
+# Escaneo por lotes con la lista nativa de nuclei (-l)
+BATCH_MAX_TARGETS = int(os.environ.get("BATCH_MAX_TARGETS", "5000"))
+BATCH_MAX_SHARDS = int(os.environ.get("BATCH_MAX_SHARDS", "8"))
+
+# --- 2.0 MÉTRICAS (FORMATO PROMETHEUS) ---
+# Registro mínimo en memoria, sin dependencias: cada observación es una
+# suma bajo un lock, así que puede quedar activo en producción.
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1") == "1"
+BUCKETS_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_ETAPA = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+def _etiquetas(nombres: tuple, valores: tuple) -> str:
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+class Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre: str, ayuda: str, labels: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.labels = labels
+        self.valores: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        registro_metricas.append(self)
+
+    def _clave(self, labels: dict) -> tuple:
+        return tuple(labels.get(nombre, "") for nombre in self.labels)
+
+    def muestras(self):
+        with self.lock:
+            if not self.labels and not self.valores:
+                return [(self.nombre, (), 0)]
+            return [(self.nombre, clave, valor) for clave, valor in self.valores.items()]
+
+    def exponer(self) -> str:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        for nombre, clave, valor in self.muestras():
+            lineas.append(f"{nombre}{_etiquetas(self.labels, clave)} {valor}")
+        return "\n".join(lineas)
+
+class Counter(Metrica):
+    tipo = "counter"
+
+    def inc(self, valor: float = 1, **labels):
+        clave = self._clave(labels)
+        with self.lock:
+            self.valores[clave] = self.valores.get(clave, 0) + valor
+
+class Gauge(Metrica):
+    tipo = "gauge"
+
+    def __init__(self, nombre: str, ayuda: str, labels: tuple = (), funcion=None):
+        super().__init__(nombre, ayuda, labels)
+        self.funcion = funcion  # valor calculado al momento del scrape
+
+    def inc(self, valor: float = 1, **labels):
+        clave = self._clave(labels)
+        with self.lock:
+            self.valores[clave] = self.valores.get(clave, 0) + valor
+
+    def dec(self, valor: float = 1, **labels):
+        self.inc(-valor, **labels)
+
+    def muestras(self):
+        if self.funcion is not None:
+            return [(self.nombre, (), self.funcion())]
+        return super().muestras()
+
+class Histogram(Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, labels: tuple = (), buckets: tuple = BUCKETS_HTTP):
+        super().__init__(nombre, ayuda, labels)
+        self.buckets = buckets
+
+    def observe(self, valor: float, **labels):
+        clave = self._clave(labels)
+        with self.lock:
+            estado = self.valores.get(clave)
+            if estado is None:
+                # [conteos por bucket..., suma, total]
+                estado = self.valores[clave] = [0] * (len(self.buckets) + 2)
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    estado[i] += 1
+                    break
+            estado[-2] += valor
+            estado[-1] += 1
+
+    def exponer(self) -> str:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self.lock:
+            estados = [(clave, list(estado)) for clave, estado in self.valores.items()]
+        for clave, estado in estados:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, estado):
+                acumulado += conteo
+                etiquetas = _etiquetas(self.labels + ("le",), clave + (limite,))
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            etiquetas = _etiquetas(self.labels + ("le",), clave + ("+Inf",))
+            lineas.append(f"{self.nombre}_bucket{etiquetas} {estado[-1]}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.labels, clave)} {estado[-2]}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.labels, clave)} {estado[-1]}")
+        return "\n".join(lineas)
 
-NUCLEI_PATH = shutil.which("nuclei") or "/usr/local/bin/nuclei" 
+registro_metricas: list[Metrica] = []
+
+HTTP_REQUESTS = Counter("http_requests_total", "Peticiones HTTP atendidas", ("method", "path", "status"))
+HTTP_DURACION = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP", ("method", "path"))
+ETAPA_DURACION = Histogram(
+    "scan_stage_duration_seconds", "Duración de cada etapa del escaneo y del reporte",
+    ("stage",), buckets=BUCKETS_ETAPA
+)
+NUCLEI_ACTIVOS = Gauge("nuclei_active_processes", "Subprocesos de nuclei en ejecución")
+NUCLEI_EJECUCIONES = Counter("nuclei_processes_total", "Subprocesos de nuclei lanzados")
+NUCLEI_HALLAZGOS = Counter("nuclei_findings_total", "Hallazgos únicos leídos de nuclei")
+NUCLEI_LINEAS_INVALIDAS = Counter("nuclei_malformed_lines_total", "Líneas de nuclei que no son JSON válido")
+CACHE_CONSULTAS = Counter("scan_cache_requests_total", "Consultas a la caché de resultados", ("result",))
+PDF_CACHE_CONSULTAS = Counter("pdf_cache_requests_total", "Consultas a la caché de PDFs", ("result",))
+DB_ERRORES = Counter("db_errors_total", "Errores de base de datos", ("operation",))
+
+def _tasa_aciertos_cache() -> float:
+    with CACHE_CONSULTAS.lock:
+        aciertos = CACHE_CONSULTAS.valores.get(("hit",), 0)
+        total = sum(CACHE_CONSULTAS.valores.values())
+    return aciertos / total if total else 0.0
+
+CACHE_TASA = Gauge("scan_cache_hit_ratio", "Proporción de consultas servidas desde la caché", funcion=_tasa_aciertos_cache)
+
+# Tiempos por etapa de la petición en curso, para la cabecera Server-Timing
+tiempos_peticion: ContextVar[dict | None] = ContextVar("tiempos_peticion", default=None)
+
+def registrar_etapa(etapa: str, duracion: float):
+    ETAPA_DURACION.observe(duracion, stage=etapa)
+    tiempos = tiempos_peticion.get()
+    if tiempos is not None:
+        tiempos[etapa] = tiempos.get(etapa, 0) + duracion
+
+@contextmanager
+def medir_etapa(etapa: str):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_etapa(etapa, time.perf_counter() - inicio)
+
+class MetricasMiddleware:
+    """Middleware ASGI: latencia y conteo por ruta y cabecera Server-Timing.
+    La ruta se toma de la plantilla (/scans/{job_id}) para acotar etiquetas."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        tiempos = {}
+        token = tiempos_peticion.set(tiempos)
+        status = 500
+
+        async def send_con_metricas(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    total = (time.perf_counter() - inicio) * 1000
+                    valor = ", ".join(
+                        [f"{etapa};dur={duracion * 1000:.1f}" for etapa, duracion in tiempos.items()]
+                        + [f"app;dur={total:.1f}"]
+                    )
+                    message.setdefault("headers", []).append((b"server-timing", valor.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_con_metricas)
+        finally:
+            tiempos_peticion.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "desconocida")
+            HTTP_REQUESTS.inc(method=scope["method"], path=path, status=status)
+            HTTP_DURACION.observe(time.perf_counter() - inicio, method=scope["method"], path=path)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
-    allow_credentials=True
+    allow_credentials=True,
+    expose_headers=["X-Next-Cursor", "Server-Timing"]
 )
+app.add_middleware(MetricasMiddleware)
 
-class ScanRequest(BaseModel):
+class SeleccionPlantillas(BaseModel):
+    profile: str | None = None  # quick | standard | deep (ver PERFILES_ESCANEO)
+    tags: List[str] = []        # reemplazan los tags del perfil
+    severities: List[str] = []  # reemplazan las severidades del perfil
+
+class ScanRequest(SeleccionPlantillas):
     url: str
     vulnerabilities: List[Any] = []
+    force: bool = False  # ignorar la caché y lanzar un escaneo nuevo
+    scan_id: int | None = None  # /scan-pdf: usar los hallazgos guardados
+    backend: str = "fpdf"  # /scan-pdf: "fpdf" o "html" (WeasyPrint)
+
+class DiffRequest(SeleccionPlantillas):
+    url: str
+    verify: bool = False  # solo re-ejecutar las plantillas que encontraron algo
+
+class BatchOptions(SeleccionPlantillas):
+    concurrency: int | None = Field(default=None, gt=0)  # -c: plantillas en paralelo
+    rate_limit: int | None = Field(default=None, gt=0)   # -rl: peticiones por segundo
+    bulk_size: int | None = Field(default=None, gt=0)    # -bulk-size: hosts en paralelo por plantilla
+    shards: int = Field(default=1, ge=1)                 # procesos de nuclei en paralelo
+
+class BatchScanRequest(BatchOptions):
+    targets: List[str]
 
 def cleanup_file(path: str):
     if os.path.exists(path):
@@ -55,162 +389,1444 @@ def cleanup_file(path: str):
         except Exception as e:
             print(f"⚠️ No se pudo eliminar {path}: {e}")
 
-async def ejecutar_nuclei_async(url: str):
+def _clave_hallazgo(v: dict) -> str:
+    # Nuclei publica el identificador como "template-id"; "templateID" se
+    # mantiene por compatibilidad con salidas antiguas.
+    template_id = v.get("template-id") or v.get("templateID")
+    return f"{template_id}-{v.get('matched-at')}"
+
+def _clave_resumen(item: dict) -> str:
+    # Misma clave que _clave_hallazgo, sobre un hallazgo ya resumido
+    return f"{item.get('templateID')}-{item.get('matchedAt')}"
+
+def _resumir_hallazgo(v: dict) -> dict:
+    info = v.get("info", {})
+    return {
+        "templateID": v.get("template-id"),
+        "matchedAt": v.get("matched-at"),
+        "severity": info.get("severity"),
+        "name": info.get("name"),
+        "description": info.get("description") or "Sin descripción",
+        "reference": info.get("reference", [])
+    }
+
+async def _drenar_stderr(stream: asyncio.StreamReader, buffer: deque):
+    # Nuclei escribe progreso y banner en stderr; si no se consume, el pipe
+    # se llena y el proceso queda bloqueado. Solo se guardan las últimas líneas.
+    async for line in stream:
+        buffer.append(line.decode(errors="replace").rstrip())
+
+nuclei_semaforo = asyncio.Semaphore(NUCLEI_MAX_PROCESOS)
+
+async def _stream_nuclei(args: list[str], stderr_buffer: deque | None = None):
+    """Ejecuta nuclei con los argumentos dados y produce cada hallazgo crudo
+    (sin duplicados) en cuanto aparece en stdout, sin acumular la salida."""
     if not NUCLEI_PATH:
         raise HTTPException(status_code=500, detail="Nuclei no encontrado")
 
-    print(f"➡️ Iniciando escaneo asíncrono en: {url}")
-    
-    # Creamos el subproceso correctamente con await
-    process = await asyncio.create_subprocess_exec(
-        NUCLEI_PATH, "-u", url, "-jsonl",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    if stderr_buffer is None:
+        stderr_buffer = deque(maxlen=STDERR_MAX_LINEAS)
 
-    stdout, stderr = await process.communicate()
-    
-    findings = []
-    output_text = stdout.decode()
-    
-    for line in output_text.split("\n"):
-        if line.strip():
+    with medir_etapa("nuclei_wait"):
+        await nuclei_semaforo.acquire()
+    inicio = time.perf_counter()
+    try:
+        with medir_etapa("spawn"):
+            process = await asyncio.create_subprocess_exec(
+                NUCLEI_PATH, *args, "-jsonl",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=NUCLEI_MAX_LINEA
+            )
+    except BaseException:
+        nuclei_semaforo.release()
+        raise
+    NUCLEI_EJECUCIONES.inc()
+    NUCLEI_ACTIVOS.inc()
+    stderr_task = asyncio.create_task(_drenar_stderr(process.stderr, stderr_buffer))
+    seen = set()
+    # El parseo se acumula localmente y se registra una sola vez
+    tiempo_parseo = 0.0
+    primer_hallazgo = True
+
+    try:
+        while True:
             try:
-                findings.append(json.loads(line))
+                line = await process.stdout.readline()
+            except ValueError:
+                # Línea mayor que el límite del buffer: se descarta y se sigue
+                continue
+            if not line:
+                break
+            inicio_parseo = time.perf_counter()
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                v = json.loads(line)
             except json.JSONDecodeError:
+                NUCLEI_LINEAS_INVALIDAS.inc()
                 continue
 
-    summary = []
-    seen = set()
+            key = _clave_hallazgo(v)
+            tiempo_parseo += time.perf_counter() - inicio_parseo
+            if key in seen:
+                continue
+            seen.add(key)
+            NUCLEI_HALLAZGOS.inc()
+            if primer_hallazgo:
+                primer_hallazgo = False
+                registrar_etapa("first_finding", time.perf_counter() - inicio)
+            yield v
 
-    for v in findings:
-        info = v.get("info", {})
-        key = f"{v.get('templateID')}-{v.get('matched-at')}"
+        await process.wait()
+        await stderr_task
+        if process.returncode != 0:
+            # Un fallo de nuclei no debe confundirse con "0 hallazgos": no se
+            # guarda en historial ni en caché
+            detalle = "\n".join(list(stderr_buffer)[-NUCLEI_ERROR_LINEAS:])
+            raise HTTPException(
+                status_code=502,
+                detail=f"Nuclei terminó con código {process.returncode}: {detalle}".strip()
+            )
+    finally:
+        # Primero la limpieza que no cede el event loop: si el cliente se
+        # desconectó, anyio vuelve a cancelar la tarea en cada await y el
+        # resto del bloque no llegaría a ejecutarse.
+        if not stderr_task.done():
+            stderr_task.cancel()
+        NUCLEI_ACTIVOS.dec()
+        registrar_etapa("parse", tiempo_parseo)
+        registrar_etapa("nuclei", time.perf_counter() - inicio)
+        try:
+            # Si el cliente se desconecta o la tarea se cancela, no dejamos
+            # procesos de nuclei huérfanos.
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        finally:
+            # El hueco se libera aunque la espera se cancele; si no, cada
+            # desconexión dejaría un hueco menos para todos los escaneos
+            nuclei_semaforo.release()
 
-        if key not in seen:
-            seen.add(key)
-            summary.append({
-                "templateID": v.get("template-id"),
-                "matchedAt": v.get("matched-at"),
-                "severity": info.get("severity"),
-                "name": info.get("name"),
-                "description": info.get("description") or "Sin descripción",
-                "reference": info.get("reference", [])
-            })
+async def stream_nuclei_findings(
+    url: str, stderr_buffer: deque | None = None, args_extra: tuple[str, ...] = ()
+):
+    """Igual que _stream_nuclei para un único objetivo, con los hallazgos
+    ya resumidos para el frontend."""
+    print(f"➡️ Iniciando escaneo asíncrono en: {url}")
+    async for v in _stream_nuclei(["-u", url, *args_extra], stderr_buffer):
+        yield _resumir_hallazgo(v)
+
+async def ejecutar_nuclei_async(url: str, args_extra: tuple[str, ...] = ()):
+    stderr_buffer = deque(maxlen=STDERR_MAX_LINEAS)
+    summary = [v async for v in stream_nuclei_findings(url, stderr_buffer, args_extra)]
+    return summary, "\n".join(stderr_buffer).strip()
+
+def _filas_hallazgos(scan: ScanHistory, summary: list) -> list[dict]:
+    return [
+        {
+            "scan_id": scan.id,
+            "url": scan.url,
+            "scan_date": scan.scan_date,
+            "template_id": item.get("templateID"),
+            "severity": item.get("severity"),
+            "name": item.get("name"),
+            "matched_at": item.get("matchedAt"),
+            "description": item.get("description"),
+            "reference": json.dumps(item.get("reference") or [], ensure_ascii=False),
+        }
+        for item in summary
+    ]
+
+def guardar_escaneos(resultados: dict[str, list], seleccion: str = "") -> dict[str, int]:
+    """Guarda cada escaneo con sus hallazgos en una única transacción
+    (inserción masiva) y devuelve el id asignado a cada URL."""
+    try:
+        with medir_etapa("db_commit"), Session(engine) as session:
+            scans = {
+                url: ScanHistory(url=url, vulnerabilities_count=len(summary), templates=seleccion)
+                for url, summary in resultados.items()
+            }
+            session.add_all(scans.values())
+            session.flush()
+            filas = [
+                fila
+                for url, summary in resultados.items()
+                for fila in _filas_hallazgos(scans[url], summary)
+            ]
+            if filas:
+                session.execute(insert(Finding), filas)
+            session.commit()
+            print(f"💾 Historial guardado: {len(scans)} escaneos - {len(filas)} hallazgos")
+            return {url: scan.id for url, scan in scans.items()}
+    except Exception as db_error:
+        DB_ERRORES.inc(operation="guardar_escaneos")
+        print(f"⚠️ Error guardando en DB: {db_error}")
+        return {}
+
+def guardar_historial(url: str, summary: list, seleccion: str = "") -> int | None:
+    return guardar_escaneos({url: summary}, seleccion).get(url)
+
+# --- 2.1 CACHÉ DE RESULTADOS ---
+# Un escaneo repetido sobre la misma URL, con la misma versión de nuclei y
+# la misma selección de plantillas, se sirve desde SQLite mientras no haya
+# vencido. Los escaneos idénticos simultáneos comparten un único subproceso.
+nuclei_version: str | None = None
+nuclei_version_lock = asyncio.Lock()
+scans_en_vuelo: dict[str, dict] = {}
+
+async def obtener_version_nuclei() -> str:
+    global nuclei_version
+    if nuclei_version is not None:
+        return nuclei_version
+    # En frío, N escaneos simultáneos lanzarían N procesos "nuclei -version"
+    # fuera del límite NUCLEI_MAX_PROCESOS: solo consulta uno y el resto espera
+    async with nuclei_version_lock:
+        if nuclei_version is None:
+            try:
+                async with nuclei_semaforo:
+                    process = await asyncio.create_subprocess_exec(
+                        NUCLEI_PATH, "-version",
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE
+                    )
+                    try:
+                        stdout, stderr = await process.communicate()
+                    finally:
+                        if process.returncode is None:
+                            process.kill()
+                versiones = re.findall(r"v\d+\.\d+\.\d+\S*", (stdout + stderr).decode(errors="replace"))
+                nuclei_version = " ".join(versiones) or "desconocida"
+            except OSError:
+                return "desconocida"
+    return nuclei_version
+
+def normalizar_url(url: str) -> str:
+    url = url.strip()
+    if "://" not in url:
+        # Sin esquema solo el host es insensible a mayúsculas, no la ruta
+        host, separador, resto = url.partition("/")
+        return (host.lower() + separador + resto).rstrip("/")
+    parsed = urlsplit(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    puerto_defecto = {"http": ":80", "https": ":443"}.get(scheme)
+    if puerto_defecto and netloc.endswith(puerto_defecto):
+        netloc = netloc[: -len(puerto_defecto)]
+    return urlunsplit((scheme, netloc, parsed.path.rstrip("/"), parsed.query, ""))
+
+def _clave_cache(url: str, version: str, plantillas: str) -> str:
+    return hashlib.sha256(f"{normalizar_url(url)}|{version}|{plantillas}".encode()).hexdigest()
+
+def _leer_cache(key: str) -> ScanCache | None:
+    with Session(engine) as session:
+        entry = session.get(ScanCache, key)
+        if entry is None:
+            return None
+        ahora = datetime.utcnow()
+        if (ahora - entry.created_at).total_seconds() > SCAN_CACHE_TTL:
+            session.delete(entry)
+            session.commit()
+            return None
+        entry.last_access = ahora
+        session.add(entry)
+        session.commit()
+        session.refresh(entry)
+        return entry
+
+def _guardar_cache(key: str, url: str, version: str, plantillas: str, summary: list):
+    try:
+        with Session(engine) as session:
+            result = json.dumps(summary, ensure_ascii=False)
+            entry = session.get(ScanCache, key) or ScanCache(
+                key=key, url=url, nuclei_version=version, templates=plantillas,
+                size=0, vulnerabilities_count=0, result=""
+            )
+            entry.created_at = entry.last_access = datetime.utcnow()
+            entry.result = result
+            entry.size = len(result)
+            entry.vulnerabilities_count = len(summary)
+            session.add(entry)
+            session.commit()
+            _expulsar_cache(session)
+    except Exception as db_error:
+        DB_ERRORES.inc(operation="guardar_cache")
+        print(f"⚠️ Error guardando en caché: {db_error}")
+
+def _expulsar_cache(session: Session):
+    # Primero se eliminan las entradas vencidas y luego las menos usadas
+    # hasta respetar los límites de cantidad y tamaño.
+    limite = datetime.utcnow() - timedelta(seconds=SCAN_CACHE_TTL)
+    session.exec(delete(ScanCache).where(ScanCache.created_at < limite))
+    filas = session.exec(
+        select(ScanCache.key, ScanCache.size).order_by(ScanCache.last_access.desc())
+    ).all()
+    total = 0
+    expulsar = []
+    for i, (key, size) in enumerate(filas):
+        total += size
+        if i >= SCAN_CACHE_MAX_ENTRIES or total > SCAN_CACHE_MAX_BYTES:
+            expulsar.append(key)
+    if expulsar:
+        session.exec(delete(ScanCache).where(ScanCache.key.in_(expulsar)))
+        print(f"🧹 Caché: {len(expulsar)} entradas expulsadas")
+    session.commit()
+
+async def _escanear_y_cachear(
+    url: str, key: str, version: str, args_extra: tuple[str, ...], seleccion: str
+):
+    summary, _ = await ejecutar_nuclei_async(url, args_extra)
+    await run_in_threadpool(guardar_historial, url, summary, seleccion)
+    await run_in_threadpool(_guardar_cache, key, url, version, " ".join(args_extra), summary)
+    return summary
+
+def _liberar_en_vuelo(key: str, entrada: dict):
+    # Solo se elimina si sigue siendo la misma entrada (puede haber otra nueva)
+    if scans_en_vuelo.get(key) is entrada:
+        del scans_en_vuelo[key]
+
+async def ejecutar_nuclei_cacheado(
+    url: str, force: bool = False, args_extra: tuple[str, ...] = (), seleccion: str = ""
+):
+    """Devuelve (hallazgos, meta) usando la caché salvo que force=True.
+    meta indica si vino de caché y la antigüedad del resultado en segundos."""
+    version = await obtener_version_nuclei()
+    key = _clave_cache(url, version, " ".join(args_extra))
+
+    if not force:
+        with medir_etapa("cache_lookup"):
+            entry = await run_in_threadpool(_leer_cache, key)
+        if entry is not None:
+            CACHE_CONSULTAS.inc(result="hit")
+            edad = (datetime.utcnow() - entry.created_at).total_seconds()
+            print(f"⚡ Caché: {url} ({int(edad)}s)")
+            return json.loads(entry.result), {"cached": True, "age_seconds": int(edad)}
+
+    en_vuelo = scans_en_vuelo.get(key)
+    if en_vuelo is None:
+        CACHE_CONSULTAS.inc(result="bypass" if force else "miss")
+        task = asyncio.create_task(_escanear_y_cachear(url, key, version, args_extra, seleccion))
+        en_vuelo = {"task": task, "waiters": 0}
+        scans_en_vuelo[key] = en_vuelo
+        task.add_done_callback(lambda _, entrada=en_vuelo: _liberar_en_vuelo(key, entrada))
+    else:
+        CACHE_CONSULTAS.inc(result="coalesced")
+        print(f"🔗 Reutilizando escaneo en curso: {url}")
+
+    en_vuelo["waiters"] += 1
+    try:
+        # shield: cancelar a un solicitante no debe matar el escaneo de los demás
+        summary = await asyncio.shield(en_vuelo["task"])
+    finally:
+        en_vuelo["waiters"] -= 1
+        if en_vuelo["waiters"] == 0 and not en_vuelo["task"].done():
+            # Nadie más espera este resultado: se cancela y se mata nuclei.
+            # Se retira ya del registro para que una petición nueva no se
+            # una a una tarea que está siendo cancelada.
+            _liberar_en_vuelo(key, en_vuelo)
+            en_vuelo["task"].cancel()
+    return summary, {"cached": False, "age_seconds": 0}
+
+# --- 2.2 PERFILES E ÍNDICE DE PLANTILLAS ---
+# El índice se construye una vez leyendo solo la cabecera (id + info) de
+# cada YAML y se guarda en SQLite; resolver un perfil es una consulta.
+PERFILES_ESCANEO = {
+    "quick": {
+        "severities": ["critical", "high"],
+        "tags": ["cve", "exposure", "misconfig", "default-login", "takeover"]
+    },
+    "standard": {"severities": ["critical", "high", "medium"]},
+    "deep": {}
+}
+PROTOCOLOS_NUCLEI = {
+    "http", "requests", "dns", "network", "tcp", "file", "headless", "ssl",
+    "websocket", "whois", "code", "javascript"
+}
+
+indice_version = 0
+perfiles_resueltos: dict[tuple, tuple[str, ...]] = {}
 
-    return summary, stderr.decode().strip()
+def _valor_yaml(valor: str) -> str:
+    valor = valor.split(" #")[0].strip()
+    if len(valor) >= 2 and valor[0] == valor[-1] and valor[0] in "'\"":
+        valor = valor[1:-1]
+    return valor
+
+def _lista_yaml(valor: str) -> list[str]:
+    # "a,b", "[a, b]" o "a" -> ["a", "b"]
+    return [_valor_yaml(v) for v in valor.strip("[]").split(",") if v.strip()]
+
+def leer_cabecera_plantilla(path: str) -> dict | None:
+    """Extrae id, name, severity, author, tags y protocolo de una plantilla
+    sin un parser YAML completo: solo se lee hasta el primer bloque de
+    protocolo. Devuelve None si no es una plantilla (sin id, o workflow)."""
+    datos = {"tags": [], "author": []}
+    en_info = False
+    en_lista = None  # "tags" o "author" cuando vienen como lista en bloque
+    sangria_info = None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for raw in f:
+            line = raw.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            if not line[0].isspace():
+                en_info = False
+                en_lista = None
+                clave, _, valor = line.partition(":")
+                if clave == "id":
+                    datos["id"] = _valor_yaml(valor)
+                elif clave == "info":
+                    en_info = True
+                elif clave == "workflows":
+                    # Los workflows no se pueden pasar como plantillas con -t
+                    return None
+                elif clave in PROTOCOLOS_NUCLEI:
+                    datos["protocol"] = "http" if clave == "requests" else clave
+                    break
+                continue
+            if not en_info:
+                continue
+            contenido = line.strip()
+            if en_lista and contenido.startswith("- "):
+                datos[en_lista].append(_valor_yaml(contenido[2:]))
+                continue
+            # Solo las claves directas de info (sin metadata/classification)
+            sangria = len(line) - len(line.lstrip())
+            if sangria_info is None:
+                sangria_info = sangria
+            if sangria > sangria_info:
+                continue
+            en_lista = None
+            clave, _, valor = contenido.partition(":")
+            valor = _valor_yaml(valor)
+            if clave in ("name", "severity"):
+                datos[clave] = valor
+            elif clave in ("tags", "author"):
+                if valor:
+                    datos[clave].extend(_lista_yaml(valor))
+                else:
+                    en_lista = clave
+    if "id" not in datos:
+        return None
+    datos["tags"] = sorted({t.lower() for t in datos["tags"] if t})
+    datos["author"] = ",".join(a for a in datos["author"] if a) or None
+    return datos
+
+def construir_indice_plantillas() -> dict:
+    """Actualiza TemplateIndex de forma incremental: solo se vuelven a leer
+    los archivos nuevos o modificados y se eliminan los que ya no existen."""
+    global indice_version
+    if not os.path.isdir(NUCLEI_TEMPLATES_DIR):
+        raise HTTPException(status_code=404, detail=f"No existe el directorio {NUCLEI_TEMPLATES_DIR}")
+
+    inicio = time.perf_counter()
+    with Session(engine) as session:
+        conocidos = dict(session.exec(select(TemplateIndex.path, TemplateIndex.mtime)).all())
+        vistos = set()
+        nuevos = []
+        for raiz, dirs, archivos in os.walk(NUCLEI_TEMPLATES_DIR):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for archivo in archivos:
+                if not archivo.endswith((".yaml", ".yml")):
+                    continue
+                path = os.path.join(raiz, archivo)
+                vistos.add(path)
+                mtime = os.path.getmtime(path)
+                if conocidos.get(path) == mtime:
+                    continue
+                try:
+                    datos = leer_cabecera_plantilla(path)
+                except OSError:
+                    continue
+                if datos is not None:
+                    nuevos.append((path, mtime, datos))
+
+        obsoletos = (set(conocidos) - vistos) | {path for path, _, _ in nuevos if path in conocidos}
+        for lote in (list(obsoletos)[i:i + 500] for i in range(0, len(obsoletos), 500)):
+            session.exec(delete(TemplateTag).where(TemplateTag.path.in_(lote)))
+            session.exec(delete(TemplateIndex).where(TemplateIndex.path.in_(lote)))
+        if nuevos:
+            session.execute(insert(TemplateIndex), [
+                {
+                    "path": path,
+                    "template_id": datos["id"],
+                    "name": datos.get("name"),
+                    "severity": (datos.get("severity") or "").lower() or None,
+                    "protocol": datos.get("protocol"),
+                    "author": datos.get("author"),
+                    "mtime": mtime
+                }
+                for path, mtime, datos in nuevos
+            ])
+            filas_tags = [{"path": path, "tag": tag} for path, _, datos in nuevos for tag in datos["tags"]]
+            if filas_tags:
+                session.execute(insert(TemplateTag), filas_tags)
+        session.commit()
+        total = session.exec(select(func.count()).select_from(TemplateIndex)).one()
+
+    indice_version += 1
+    perfiles_resueltos.clear()
+    resumen = {
+        "templates": total,
+        "updated": len(nuevos),
+        "removed": len(set(conocidos) - vistos),
+        "seconds": round(time.perf_counter() - inicio, 3)
+    }
+    print(f"📚 Índice de plantillas: {resumen}")
+    return resumen
+
+def _criterios(seleccion: SeleccionPlantillas) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    if seleccion.profile and seleccion.profile not in PERFILES_ESCANEO:
+        raise HTTPException(status_code=400, detail=f"profile debe ser uno de {list(PERFILES_ESCANEO)}")
+    perfil = PERFILES_ESCANEO.get(seleccion.profile or "", {})
+    tags = seleccion.tags or perfil.get("tags", [])
+    severities = seleccion.severities or perfil.get("severities", [])
+    return (
+        tuple(sorted({t.lower() for t in tags})),
+        tuple(sorted({s.lower() for s in severities}))
+    )
+
+def describir_seleccion(seleccion: SeleccionPlantillas) -> str:
+    # Forma canónica de la selección, independiente del contenido del índice
+    tags, severities = _criterios(seleccion)
+    if not tags and not severities:
+        return ""
+    return f"tags={','.join(tags)};severities={','.join(severities)}"
+
+def _plantillas_del_indice(tags: tuple[str, ...], severities: tuple[str, ...]) -> list[str] | None:
+    # None si el índice está vacío (se usan los filtros nativos de nuclei)
+    with Session(engine) as session:
+        if session.exec(select(TemplateIndex.path).limit(1)).first() is None:
+            return None
+        statement = select(TemplateIndex.path)
+        if severities:
+            statement = statement.where(TemplateIndex.severity.in_(severities))
+        if tags:
+            statement = statement.where(
+                select(TemplateTag.path)
+                .where(TemplateTag.path == TemplateIndex.path, TemplateTag.tag.in_(tags))
+                .exists()
+            )
+        return list(session.exec(statement.order_by(TemplateIndex.path)).all())
+
+async def resolver_plantillas(seleccion: SeleccionPlantillas) -> tuple[str, ...]:
+    """Traduce un perfil/tags/severidades a argumentos de nuclei. Con índice
+    se pasa una lista de plantillas (-t archivo); sin índice se recurre a
+    -tags / -severity. El resultado se memoriza hasta el siguiente build."""
+    tags, severities = _criterios(seleccion)
+    if not tags and not severities:
+        return ()
+
+    clave = (tags, severities, indice_version)
+    args = perfiles_resueltos.get(clave)
+    # La lista en /tmp puede haber sido borrada por el sistema
+    if args is not None and (args[:1] != ("-t",) or os.path.exists(args[1])):
+        return args
+
+    paths = await run_in_threadpool(_plantillas_del_indice, tags, severities)
+    if paths is None:
+        args = []
+        if tags:
+            args += ["-tags", ",".join(tags)]
+        if severities:
+            args += ["-severity", ",".join(severities)]
+        args = tuple(args)
+    else:
+        if not paths:
+            raise HTTPException(status_code=400, detail="Ninguna plantilla coincide con la selección")
+        contenido = "\n".join(paths) + "\n"
+        # Nombre derivado del contenido: la misma selección produce siempre
+        # el mismo argumento y por tanto la misma clave de caché
+        digest = hashlib.sha256(contenido.encode()).hexdigest()[:16]
+        lista_path = os.path.join(tempfile.gettempdir(), f"nuclei-plantillas-{digest}.txt")
+        if not os.path.exists(lista_path):
+            with open(lista_path, "w") as f:
+                f.write(contenido)
+        args = ("-t", lista_path)
+
+    perfiles_resueltos[clave] = args
+    return args
+
+@app.on_event("startup")
+async def iniciar_indice_plantillas():
+    # Solo se construye al arrancar si está vacío; después se actualiza con
+    # POST /templates/index
+    def _indice_vacio():
+        with Session(engine) as session:
+            return session.exec(select(TemplateIndex.path).limit(1)).first() is None
+
+    if os.path.isdir(NUCLEI_TEMPLATES_DIR) and await run_in_threadpool(_indice_vacio):
+        await run_in_threadpool(construir_indice_plantillas)
+
+@app.post("/templates/index")
+async def reconstruir_indice_plantillas():
+    return {"status": "ok", **await run_in_threadpool(construir_indice_plantillas)}
+
+@app.get("/templates/profiles")
+async def get_profiles():
+    perfiles = {}
+    for nombre in PERFILES_ESCANEO:
+        args = await resolver_plantillas(SeleccionPlantillas(profile=nombre))
+        if args[:1] == ("-t",):
+            with open(args[1]) as f:
+                templates = sum(1 for _ in f)
+        else:
+            templates = None  # todas, o filtradas por nuclei sin índice
+        perfiles[nombre] = {**PERFILES_ESCANEO[nombre], "templates": templates}
+    return perfiles
 
 # --- 3. ENDPOINT DE ESCANEO (CON BASE DE DATOS) ---
 @app.post("/scan-json")
 async def scan_url_json(request: ScanRequest):
     try:
-        # Ejecutar escaneo
-        summary, stderr = await ejecutar_nuclei_async(request.url)
-        
-        # --- GUARDAR EN BASE DE DATOS ---
-        try:
-            with Session(engine) as session:
-                nuevo_registro = ScanHistory(
-                    url=request.url,
-                    vulnerabilities_count=len(summary)
-                )
-                session.add(nuevo_registro)
-                session.commit()
-                print(f"💾 Historial guardado: {request.url} - {len(summary)} hallazgos")
-        except Exception as db_error:
-            print(f"⚠️ Error guardando en DB: {db_error}")
-        # -------------------------------
+        # Ejecutar escaneo (o servirlo desde la caché); el historial se
+        # guarda solo cuando nuclei se ejecuta de verdad
+        args_extra = await resolver_plantillas(request)
+        summary, meta = await ejecutar_nuclei_cacheado(
+            request.url, request.force, args_extra, describir_seleccion(request)
+        )
 
         return {
             "status": "ok",
             "count": len(summary),
-            "vulnerabilities": summary
+            "vulnerabilities": summary,
+            **meta
         }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+# --- 3.1 ENDPOINT DE ESCANEO EN STREAMING (NDJSON / SSE) ---
+def _formatear_evento(tipo: str, data: dict, sse: bool) -> str:
+    if sse:
+        return f"event: {tipo}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": tipo, "data": data}, ensure_ascii=False) + "\n"
+
+async def _eventos_escaneo(url: str, sse: bool, seleccion: SeleccionPlantillas):
+    # Cada hallazgo se envía al cliente en cuanto nuclei lo emite; solo se
+    # conserva su resumen (sin request/response) para guardarlo al final.
+    findings = []
+    try:
+        args_extra = await resolver_plantillas(seleccion)
+        async for finding in stream_nuclei_findings(url, args_extra=args_extra):
+            findings.append(finding)
+            yield _formatear_evento("finding", finding, sse)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        yield _formatear_evento("error", {"status": "error", "message": detail}, sse)
+        return
+
+    await run_in_threadpool(guardar_historial, url, findings, describir_seleccion(seleccion))
+    yield _formatear_evento("done", {"status": "ok", "count": len(findings)}, sse)
+
+def _respuesta_stream(url: str, request: Request, formato: str | None, seleccion: SeleccionPlantillas):
+    sse = formato == "sse" or (
+        formato is None and "text/event-stream" in request.headers.get("accept", "")
+    )
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(
+        _eventos_escaneo(url, sse, seleccion),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/scan-stream")
+async def scan_url_stream_get(
+    url: str, request: Request, formato: str | None = None, profile: str | None = None
+):
+    # GET para poder usar EventSource desde el navegador
+    return _respuesta_stream(url, request, formato, SeleccionPlantillas(profile=profile))
+
+@app.post("/scan-stream")
+async def scan_url_stream(body: ScanRequest, request: Request, formato: str | None = None):
+    return _respuesta_stream(body.url, request, formato, body)
+
+# --- 3.2 COLA DE TRABAJOS DE ESCANEO ---
+# Los trabajos se guardan en SQLite; la cola en memoria solo contiene ids,
+# así que al reiniciar se reconstruye a partir de la tabla ScanJob.
+scan_queue: asyncio.Queue | None = None
+scan_workers: list[asyncio.Task] = []
+running_jobs: dict[int, asyncio.Task] = {}
+cancel_requested: set[int] = set()
+
+COLA_PROFUNDIDAD = Gauge(
+    "scan_queue_depth", "Trabajos de escaneo en espera",
+    funcion=lambda: scan_queue.qsize() if scan_queue is not None else 0
+)
+JOBS_EN_CURSO = Gauge("scan_jobs_running", "Trabajos de escaneo en ejecución", funcion=lambda: len(running_jobs))
+
+def _actualizar_job(job_id: int, **campos) -> ScanJob | None:
+    with Session(engine) as session:
+        job = session.get(ScanJob, job_id)
+        if job is None:
+            return None
+        for campo, valor in campos.items():
+            setattr(job, campo, valor)
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job
+
+def _jobs_pendientes() -> list[int]:
+    with Session(engine) as session:
+        # Los trabajos que estaban corriendo cuando se detuvo el servidor
+        # vuelven a la cola.
+        interrumpidos = session.exec(select(ScanJob).where(ScanJob.status == "running")).all()
+        for job in interrumpidos:
+            job.status = "queued"
+            job.started_at = None
+            session.add(job)
+        session.commit()
+        statement = select(ScanJob.id).where(ScanJob.status == "queued").order_by(ScanJob.id)
+        return list(session.exec(statement).all())
+
+def _tomar_job(job_id: int) -> ScanJob | None:
+    # Paso atómico queued -> running: un UPDATE condicional para no competir
+    # con una cancelación que llegue desde otro hilo
+    with Session(engine) as session:
+        resultado = session.execute(
+            update(ScanJob)
+            .where(ScanJob.id == job_id, ScanJob.status == "queued")
+            .values(status="running", started_at=datetime.utcnow())
+        )
+        session.commit()
+        if resultado.rowcount == 0:
+            return None
+        return session.get(ScanJob, job_id)
+
+def _cancelar_en_cola(job_id: int) -> tuple[bool, str | None]:
+    # Paso atómico queued -> cancelled; si no aplica devuelve el estado actual
+    with Session(engine) as session:
+        resultado = session.execute(
+            update(ScanJob)
+            .where(ScanJob.id == job_id, ScanJob.status == "queued")
+            .values(status="cancelled", finished_at=datetime.utcnow())
+        )
+        session.commit()
+        if resultado.rowcount:
+            return True, "cancelled"
+        job = session.get(ScanJob, job_id)
+        return False, job.status if job is not None else None
+
+async def _ejecutar_job_nuclei(job: ScanJob):
+    seleccion = SeleccionPlantillas(
+        profile=job.profile,
+        tags=[t for t in job.tags.split(",") if t],
+        severities=[s for s in job.severities.split(",") if s]
+    )
+    args_extra = await resolver_plantillas(seleccion)
+    return await ejecutar_nuclei_cacheado(job.url, job.force, args_extra, describir_seleccion(seleccion))
+
+async def _ejecutar_job(job_id: int):
+    job = await run_in_threadpool(_tomar_job, job_id)
+    if job is None:
+        return
+    # Un DELETE que llegó mientras se tomaba el trabajo lo deja marcado en
+    # cancel_requested. Desde aquí hasta registrar la tarea no se cede el
+    # event loop, así DELETE /scans/{id} ve una de las dos cosas.
+    if job_id in cancel_requested:
+        cancel_requested.discard(job_id)
+        await run_in_threadpool(_actualizar_job, job_id, status="cancelled", finished_at=datetime.utcnow())
+        print(f"🛑 Trabajo {job_id} cancelado")
+        return
+    task = asyncio.create_task(_ejecutar_job_nuclei(job))
+    running_jobs[job_id] = task
+
+    try:
+        try:
+            summary, _ = await task
+        finally:
+            # Se quita antes de guardar el estado final: un DELETE que llegue
+            # mientras tanto debe ver el estado en la base de datos, no una
+            # tarea que ya terminó
+            running_jobs.pop(job_id, None)
+    except asyncio.CancelledError:
+        if job_id in cancel_requested:
+            cancel_requested.discard(job_id)
+            await run_in_threadpool(_actualizar_job, job_id, status="cancelled", finished_at=datetime.utcnow())
+            print(f"🛑 Trabajo {job_id} cancelado")
+            return
+        if asyncio.current_task().cancelling():
+            # Apagado del servidor: el trabajo queda en "running" y se
+            # reencola al arrancar
+            raise
+        # Se canceló la tarea interna sin que nadie lo pidiera: es un fallo
+        # del trabajo, no del worker
+        await run_in_threadpool(
+            _actualizar_job, job_id, status="error", error="Escaneo cancelado", finished_at=datetime.utcnow()
+        )
+        print(f"❌ Trabajo {job_id} falló: escaneo cancelado")
+        return
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        await run_in_threadpool(_actualizar_job, job_id, status="error", error=detail, finished_at=datetime.utcnow())
+        print(f"❌ Trabajo {job_id} falló: {detail}")
+        return
+    finally:
+        # Un DELETE que llegó con la tarea ya terminada no tiene efecto
+        cancel_requested.discard(job_id)
+
+    await run_in_threadpool(
+        _actualizar_job, job_id,
+        status="done",
+        vulnerabilities_count=len(summary),
+        result=json.dumps(summary, ensure_ascii=False),
+        finished_at=datetime.utcnow()
+    )
+
+async def _worker(numero: int):
+    while True:
+        job_id = await scan_queue.get()
+        try:
+            await _ejecutar_job(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Worker {numero}: error en trabajo {job_id}: {e}")
+        finally:
+            scan_queue.task_done()
+
+@app.on_event("startup")
+async def iniciar_workers():
+    global scan_queue
+    scan_queue = asyncio.Queue()
+    pendientes = await run_in_threadpool(_jobs_pendientes)
+    for job_id in pendientes:
+        scan_queue.put_nowait(job_id)
+    if pendientes:
+        print(f"♻️ {len(pendientes)} trabajos pendientes recuperados")
+    scan_workers.extend(asyncio.create_task(_worker(i)) for i in range(SCAN_WORKERS))
+
+@app.on_event("shutdown")
+async def detener_workers():
+    # Los trabajos en curso quedan en "running" y se reencolan al arrancar
+    for task in scan_workers:
+        task.cancel()
+    await asyncio.gather(*scan_workers, return_exceptions=True)
+    scan_workers.clear()
+
+def _job_a_dict(job: ScanJob) -> dict:
+    data = {
+        "id": job.id,
+        "url": job.url,
+        "status": job.status,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+    if job.status == "done":
+        data["count"] = job.vulnerabilities_count
+        data["vulnerabilities"] = json.loads(job.result or "[]")
+    if job.status == "error":
+        data["message"] = job.error
+    return data
+
+@app.post("/scans", status_code=202)
+async def crear_scan(request: ScanRequest):
+    # Validar el perfil antes de encolar
+    _criterios(request)
+    # Control de admisión: con la cola llena se rechaza en vez de acumular
+    if scan_queue.qsize() >= SCAN_QUEUE_MAX:
+        raise HTTPException(
+            status_code=429,
+            detail="Cola de escaneos llena, intenta más tarde",
+            headers={"Retry-After": "30"}
+        )
+
+    def _crear():
+        with Session(engine) as session:
+            job = ScanJob(
+                url=request.url, force=request.force, profile=request.profile,
+                tags=",".join(request.tags), severities=",".join(request.severities)
+            )
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            return job
+
+    job = await run_in_threadpool(_crear)
+    scan_queue.put_nowait(job.id)
+    print(f"📥 Trabajo {job.id} encolado: {job.url}")
+    return {"status": "ok", "job_id": job.id, "queue_position": scan_queue.qsize()}
+
+@app.get("/scans/{job_id}")
+def get_scan(job_id: int):
+    with Session(engine) as session:
+        job = session.get(ScanJob, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+        return _job_a_dict(job)
+
+@app.delete("/scans/{job_id}")
+async def cancelar_scan(job_id: int):
+    task = running_jobs.get(job_id)
+    if task is None:
+        # Sigue en la cola: el worker lo saltará al ver el estado
+        cancelado, estado = await run_in_threadpool(_cancelar_en_cola, job_id)
+        if estado is None:
+            raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+        if cancelado:
+            return {"status": "ok", "job_id": job_id}
+        if estado != "running":
+            raise HTTPException(status_code=409, detail=f"El trabajo ya está en estado {estado}")
+        task = running_jobs.get(job_id)
+
+    # Cancelar la tarea mata el subproceso de nuclei. Si el worker acaba de
+    # tomar el trabajo y aún no registró la tarea, verá la marca y no lo lanzará.
+    cancel_requested.add(job_id)
+    if task is not None:
+        task.cancel()
+    return {"status": "ok", "job_id": job_id}
+
+# --- 3.3 ESCANEO POR LOTES (LISTA NATIVA DE NUCLEI) ---
+def _limpiar_objetivos(lineas: List[str]) -> List[str]:
+    targets = []
+    seen = set()
+    for line in lineas:
+        target = line.strip()
+        if not target or target.startswith("#") or target in seen:
+            continue
+        seen.add(target)
+        targets.append(target)
+    return targets
+
+def _netloc(valor: str) -> str:
+    # "https://Example.com:8443/x" -> "example.com:8443"; "example.com" -> "example.com"
+    parsed = urlsplit(valor if "://" in valor else f"//{valor}")
+    return (parsed.netloc or parsed.path).lower()
+
+def _indice_objetivos(targets: List[str]) -> dict[str, str]:
+    indice = {}
+    for target in targets:
+        indice.setdefault(target, target)
+        indice.setdefault(target.rstrip("/"), target)
+        netloc = _netloc(target)
+        indice.setdefault(netloc, target)
+        indice.setdefault(netloc.split(":")[0], target)
+    return indice
+
+def _asignar_objetivo(v: dict, indice: dict[str, str]) -> str | None:
+    # Nuclei indica el objetivo original en "url" (v3) o "host"; si no
+    # coincide exactamente se intenta por host:puerto y luego por host.
+    candidatos = [c for c in (v.get("url"), v.get("host"), v.get("matched-at")) if c]
+    for candidato in candidatos:
+        if candidato in indice:
+            return indice[candidato]
+    for candidato in candidatos:
+        netloc = _netloc(candidato)
+        if netloc in indice:
+            return indice[netloc]
+        host = netloc.split(":")[0]
+        if host in indice:
+            return indice[host]
+    return None
+
+def _args_lote(lista_path: str, opciones: BatchOptions, args_extra: tuple[str, ...]) -> List[str]:
+    args = ["-l", lista_path, *args_extra]
+    if opciones.concurrency:
+        args += ["-c", str(opciones.concurrency)]
+    if opciones.rate_limit:
+        args += ["-rl", str(opciones.rate_limit)]
+    if opciones.bulk_size:
+        args += ["-bulk-size", str(opciones.bulk_size)]
+    return args
+
+async def _escanear_shard(
+    targets: List[str], opciones: BatchOptions, args_extra: tuple[str, ...],
+    indice: dict[str, str], results: dict
+):
+    with tempfile.NamedTemporaryFile("w", delete=False, suffix=".txt") as f:
+        f.write("\n".join(targets) + "\n")
+        lista_path = f.name
+    try:
+        async for v in _stream_nuclei(_args_lote(lista_path, opciones, args_extra)):
+            target = _asignar_objetivo(v, indice)
+            results.setdefault(target, []).append(_resumir_hallazgo(v))
+    finally:
+        cleanup_file(lista_path)
+
+async def escanear_lote(targets: List[str], opciones: BatchOptions):
+    if not targets:
+        raise HTTPException(status_code=400, detail="No se recibieron objetivos")
+    if len(targets) > BATCH_MAX_TARGETS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_MAX_TARGETS} objetivos por lote")
+
+    shards = max(1, min(opciones.shards, BATCH_MAX_SHARDS, len(targets)))
+    print(f"➡️ Iniciando escaneo por lotes: {len(targets)} objetivos en {shards} procesos")
+
+    args_extra = await resolver_plantillas(opciones)
+    indice = _indice_objetivos(targets)
+    results: dict[str | None, list] = {}
+    # Reparto round-robin para equilibrar los procesos
+    await asyncio.gather(*(
+        _escanear_shard(targets[i::shards], opciones, args_extra, indice, results)
+        for i in range(shards)
+    ))
+
+    counts = {target: len(results.get(target, [])) for target in targets}
+    await run_in_threadpool(
+        guardar_escaneos, {target: results.get(target, []) for target in targets}, describir_seleccion(opciones)
+    )
+
+    return {
+        "status": "ok",
+        "targets": len(targets),
+        "count": sum(len(items) for items in results.values()),
+        "results": {
+            target: {"count": counts[target], "vulnerabilities": results.get(target, [])}
+            for target in targets
+        },
+        "unmatched": results.get(None, [])
+    }
+
+@app.post("/scan-batch")
+async def scan_batch(request: BatchScanRequest):
+    try:
+        return await escanear_lote(_limpiar_objetivos(request.targets), request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@app.post("/scan-batch/file")
+async def scan_batch_file(
+    request: Request,
+    concurrency: int | None = Query(None, gt=0),
+    rate_limit: int | None = Query(None, gt=0),
+    bulk_size: int | None = Query(None, gt=0),
+    shards: int = Query(1, ge=1),
+    profile: str | None = None
+):
+    # El cuerpo es el archivo de objetivos tal cual (uno por línea),
+    # por ejemplo: curl --data-binary @targets.txt
+    body = (await request.body()).decode(errors="replace")
+    opciones = BatchOptions(
+        concurrency=concurrency, rate_limit=rate_limit, bulk_size=bulk_size, shards=shards,
+        profile=profile
+    )
+    try:
+        return await escanear_lote(_limpiar_objetivos(body.splitlines()), opciones)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+# --- 3.4 RE-ESCANEO DIFERENCIAL ---
+def _ultimo_escaneo(url: str, seleccion: str) -> tuple[ScanHistory | None, list]:
+    # Solo es comparable un escaneo hecho con la misma selección de plantillas
+    with Session(engine) as session:
+        scan = session.exec(
+            select(ScanHistory)
+            .where(ScanHistory.url == url, ScanHistory.templates == seleccion)
+            .order_by(ScanHistory.scan_date.desc(), ScanHistory.id.desc())
+            .limit(1)
+        ).first()
+        if scan is None:
+            return None, []
+        findings = session.exec(select(Finding).where(Finding.scan_id == scan.id)).all()
+        return scan, [_hallazgo_a_dict(f) for f in findings]
+
+def comparar_hallazgos(anteriores: list, nuevos: list) -> dict:
+    claves_anteriores = {_clave_resumen(item) for item in anteriores}
+    claves_nuevas = {_clave_resumen(item) for item in nuevos}
+    return {
+        "added": [item for item in nuevos if _clave_resumen(item) not in claves_anteriores],
+        "resolved": [item for item in anteriores if _clave_resumen(item) not in claves_nuevas],
+        "unchanged_count": len(claves_anteriores & claves_nuevas)
+    }
+
+@app.post("/scan-diff")
+async def scan_url_diff(request: DiffRequest):
+    """Compara un escaneo nuevo con el último guardado para la misma URL y
+    la misma selección de plantillas (profile/tags/severities).
+
+    En modo verify solo se ejecutan las plantillas que encontraron algo la
+    vez anterior (-id) y el resultado no se guarda en el historial, porque
+    no es un escaneo completo."""
+    try:
+        seleccion = describir_seleccion(request)
+        anterior, hallazgos_anteriores = await run_in_threadpool(_ultimo_escaneo, request.url, seleccion)
+
+        sin_verificar = []
+        try:
+            if request.verify:
+                if anterior is None:
+                    raise HTTPException(status_code=404, detail="No hay un escaneo previo para verificar")
+                # Sin templateID no se puede re-ejecutar: esos hallazgos no se
+                # comparan para no darlos por resueltos sin haberlos probado
+                sin_verificar = [f for f in hallazgos_anteriores if not f["templateID"]]
+                hallazgos_anteriores = [f for f in hallazgos_anteriores if f["templateID"]]
+                template_ids = sorted({f["templateID"] for f in hallazgos_anteriores})
+                if template_ids:
+                    nuevos, _ = await ejecutar_nuclei_async(request.url, ("-id", ",".join(template_ids)))
+                else:
+                    nuevos = []
+            else:
+                args_extra = await resolver_plantillas(request)
+                nuevos, _ = await ejecutar_nuclei_cacheado(request.url, True, args_extra, seleccion)
+        except HTTPException:
+            raise
+        except Exception as e:
+            # Si nuclei no pudo ejecutarse no hay diff posible: nunca se
+            # informan hallazgos como resueltos a partir de un escaneo fallido
+            raise HTTPException(status_code=502, detail=f"No se pudo ejecutar nuclei: {e}")
+
+        return {
+            "status": "ok",
+            "mode": "verify" if request.verify else "full",
+            "url": request.url,
+            "previous_scan_id": anterior.id if anterior else None,
+            "previous_scan_date": anterior.scan_date if anterior else None,
+            "count": len(nuevos),
+            "unverified_count": len(sin_verificar),
+            **comparar_hallazgos(hallazgos_anteriores, nuevos)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 # --- 5. NUEVO ENDPOINT PARA VER EL HISTORIAL ---
+def _codificar_cursor(scan: ScanHistory) -> str:
+    raw = f"{scan.scan_date.isoformat()}|{scan.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decodificar_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        fecha, scan_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(fecha), int(scan_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 @app.get("/history")
-def get_history():
+def get_history(
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    url: str | None = None,
+    severity: str | None = None,
+    desde: datetime | None = None,
+    hasta: datetime | None = None
+):
+    # Paginación por cursor (keyset): la siguiente página se pide con el
+    # valor de la cabecera X-Next-Cursor, sin OFFSET.
     try:
         with Session(engine) as session:
-            # Traer los últimos 50 registros, ordenados del más nuevo al más viejo
-            statement = select(ScanHistory).order_by(ScanHistory.scan_date.desc()).limit(50)
+            statement = select(ScanHistory)
+            if url:
+                statement = statement.where(ScanHistory.url == url)
+            if desde:
+                statement = statement.where(ScanHistory.scan_date >= desde)
+            if hasta:
+                statement = statement.where(ScanHistory.scan_date < hasta)
+            if severity:
+                statement = statement.where(
+                    select(Finding.id)
+                    .where(Finding.scan_id == ScanHistory.id, Finding.severity == severity.lower())
+                    .exists()
+                )
+            if cursor:
+                fecha, scan_id = _decodificar_cursor(cursor)
+                statement = statement.where(or_(
+                    ScanHistory.scan_date < fecha,
+                    and_(ScanHistory.scan_date == fecha, ScanHistory.id < scan_id)
+                ))
+            statement = statement.order_by(
+                ScanHistory.scan_date.desc(), ScanHistory.id.desc()
+            ).limit(limit)
             results = session.exec(statement).all()
+            if len(results) == limit:
+                response.headers["X-Next-Cursor"] = _codificar_cursor(results[-1])
             return results
+    except HTTPException:
+        raise
     except Exception as e:
+        DB_ERRORES.inc(operation="history")
         return {"status": "error", "message": str(e)}        
 
-# --- 4. ENDPOINT DE PDF (CON FPDF) ---
-@app.post("/scan-pdf")
-async def scan_url_pdf(request: ScanRequest, background_tasks: BackgroundTasks):
-    try:
-        summary = request.vulnerabilities
-        
-        if not summary:
-            print("⚠️ Advertencia: Lista vacía")
+def _hallazgo_a_dict(finding: Finding) -> dict:
+    return {
+        "templateID": finding.template_id,
+        "matchedAt": finding.matched_at,
+        "severity": finding.severity,
+        "name": finding.name,
+        "description": finding.description,
+        "reference": json.loads(finding.reference or "[]")
+    }
 
-        class PDF(FPDF):
-            def header(self):
-                self.set_font('Arial', 'B', 15)
-                self.cell(0, 10, 'Reporte de Vulnerabilidades', 0, 1, 'C')
-                self.ln(5)
+@app.get("/history/{scan_id}")
+def get_history_scan(scan_id: int):
+    with Session(engine) as session:
+        scan = session.get(ScanHistory, scan_id)
+        if scan is None:
+            raise HTTPException(status_code=404, detail="Escaneo no encontrado")
+        findings = session.exec(
+            select(Finding).where(Finding.scan_id == scan_id).order_by(Finding.id)
+        ).all()
+        return {
+            **scan.model_dump(),
+            "vulnerabilities": [_hallazgo_a_dict(f) for f in findings]
+        }
 
-            def footer(self):
-                self.set_y(-15)
-                self.set_font('Arial', 'I', 8)
-                self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+FORMATOS_PERIODO = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}
 
-        pdf = PDF()
-        pdf.add_page()
-        
-        pdf.set_font("Arial", size=12)
-        pdf.cell(0, 10, f"Objetivo: {request.url}", ln=True)
-        pdf.cell(0, 10, f"Total hallazgos: {len(summary)}", ln=True)
-        pdf.ln(5)
-
-        if summary:
-            pdf.set_fill_color(200, 220, 255)
-            pdf.set_font("Arial", 'B', 10)
-            pdf.cell(40, 10, "Severidad", 1, 0, 'C', fill=True)
-            pdf.cell(60, 10, "Nombre", 1, 0, 'C', fill=True)
-            pdf.cell(90, 10, "Detalle / Ruta", 1, 1, 'C', fill=True)
-
-            pdf.set_font("Arial", size=9)
-            for item in summary:
-                severity = item.get("severity", "unknown").lower()
-                if severity == "critical":
-                    pdf.set_text_color(200, 0, 0)
-                elif severity == "high":
-                    pdf.set_text_color(255, 100, 0)
-                else:
-                    pdf.set_text_color(0, 0, 0)
-
-                name_text = (item.get("name") or "")[:25]
-                match_text = (item.get("matchedAt") or "")[:40]
-                
-                pdf.cell(40, 10, severity.upper(), 1, 0, 'C')
-                pdf.cell(60, 10, name_text, 1, 0, 'L')
-                pdf.cell(90, 10, match_text, 1, 1, 'L')
-                
+@app.get("/stats/severity")
+def get_stats_severity(
+    interval: str = "day",
+    url: str | None = None,
+    desde: datetime | None = None,
+    hasta: datetime | None = None
+):
+    # Conteo de hallazgos por severidad y periodo, resuelto con los índices
+    # (scan_date, severity) y (url, scan_date) de Finding.
+    if interval not in FORMATOS_PERIODO:
+        raise HTTPException(status_code=400, detail=f"interval debe ser uno de {list(FORMATOS_PERIODO)}")
+    periodo = func.strftime(FORMATOS_PERIODO[interval], Finding.scan_date).label("period")
+    statement = select(periodo, Finding.severity, func.count().label("count"))
+    if url:
+        statement = statement.where(Finding.url == url)
+    if desde:
+        statement = statement.where(Finding.scan_date >= desde)
+    if hasta:
+        statement = statement.where(Finding.scan_date < hasta)
+    statement = statement.group_by(periodo, Finding.severity).order_by(periodo)
+    with Session(engine) as session:
+        return [
+            {"period": period, "severity": severity, "count": count}
+            for period, severity, count in session.exec(statement).all()
+        ]
+
+# --- 4. ENDPOINT DE PDF (CON FPDF O WEASYPRINT) ---
+# El render se hace en un pool de procesos para no bloquear el event loop,
+# se genera en memoria (sin archivos temporales) y se guarda en una caché
+# LRU por escaneo + hash del contenido.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Filas por documento parcial en el backend HTML
+PDF_LOTE_FILAS = 500
+PDF_TROZO_BYTES = 64 * 1024
+PDF_BACKENDS = ("fpdf", "html")
+
+pdf_executor: ProcessPoolExecutor | None = None
+pdf_cache: OrderedDict[str, bytes] = OrderedDict()
+pdf_cache_bytes = 0
+
+class ReportePDF(FPDF):
+    def header(self):
+        self.set_font('Arial', 'B', 15)
+        self.cell(0, 10, 'Reporte de Vulnerabilidades', 0, 1, 'C')
+        self.ln(5)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Arial', 'I', 8)
+        self.cell(0, 10, f'Pagina {self.page_no()}', 0, 0, 'C')
+
+def _texto_pdf(texto: str) -> str:
+    # Las fuentes base de FPDF solo admiten latin-1
+    return texto.encode("latin-1", "replace").decode("latin-1")
+
+def renderizar_pdf_fpdf(url: str, summary: list) -> bytes:
+    pdf = ReportePDF()
+    pdf.add_page()
+    
+    pdf.set_font("Arial", size=12)
+    pdf.cell(0, 10, _texto_pdf(f"Objetivo: {url}"), ln=True)
+    pdf.cell(0, 10, f"Total hallazgos: {len(summary)}", ln=True)
+    pdf.ln(5)
+
+    if summary:
+        pdf.set_fill_color(200, 220, 255)
+        pdf.set_font("Arial", 'B', 10)
+        pdf.cell(40, 10, "Severidad", 1, 0, 'C', fill=True)
+        pdf.cell(60, 10, "Nombre", 1, 0, 'C', fill=True)
+        pdf.cell(90, 10, "Detalle / Ruta", 1, 1, 'C', fill=True)
+
+        pdf.set_font("Arial", size=9)
+        for item in summary:
+            severity = (item.get("severity") or "unknown").lower()
+            if severity == "critical":
+                pdf.set_text_color(200, 0, 0)
+            elif severity == "high":
+                pdf.set_text_color(255, 100, 0)
+            else:
                 pdf.set_text_color(0, 0, 0)
-        else:
-            pdf.cell(0, 10, "No se encontraron vulnerabilidades.", ln=True)
 
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-            pdf.output(f.name)
-            pdf_path = f.name
-        
-        background_tasks.add_task(cleanup_file, pdf_path)
+            name_text = _texto_pdf((item.get("name") or "")[:25])
+            match_text = _texto_pdf((item.get("matchedAt") or "")[:40])
+            
+            pdf.cell(40, 10, _texto_pdf(severity.upper()), 1, 0, 'C')
+            pdf.cell(60, 10, name_text, 1, 0, 'L')
+            pdf.cell(90, 10, match_text, 1, 1, 'L')
+            
+            pdf.set_text_color(0, 0, 0)
+    else:
+        pdf.cell(0, 10, "No se encontraron vulnerabilidades.", ln=True)
+
+    return bytes(pdf.output())
+
+PLANTILLA_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><style>
+@page {{ size: A4; margin: 15mm; @bottom-center {{ content: "Pagina " counter(page); font-size: 8pt; }} }}
+body {{ font-family: sans-serif; font-size: 9pt; }}
+h1 {{ text-align: center; font-size: 15pt; }}
+table {{ width: 100%; border-collapse: collapse; }}
+th {{ background: #c8dcff; }}
+th, td {{ border: 1px solid #000; padding: 3px; word-break: break-all; }}
+.critical {{ color: #c80000; }} .high {{ color: #ff6400; }}
+</style></head><body>{contenido}</body></html>"""
+
+def _filas_html(items: list) -> str:
+    filas = []
+    for item in items:
+        severity = (item.get("severity") or "unknown").lower()
+        filas.append(
+            f'<tr class="{html.escape(severity)}"><td>{html.escape(severity.upper())}</td>'
+            f'<td>{html.escape(item.get("name") or "")}</td>'
+            f'<td>{html.escape(item.get("matchedAt") or "")}</td></tr>'
+        )
+    return "".join(filas)
+
+def renderizar_pdf_html(url: str, summary: list) -> bytes:
+    from weasyprint import HTML
+
+    cabecera = (
+        "<h1>Reporte de Vulnerabilidades</h1>"
+        f"<p>Objetivo: {html.escape(url)}<br>Total hallazgos: {len(summary)}</p>"
+    )
+    if not summary:
+        contenido = cabecera + "<p>No se encontraron vulnerabilidades.</p>"
+        return HTML(string=PLANTILLA_HTML.format(contenido=contenido)).write_pdf()
 
-        return FileResponse(
-            pdf_path, 
-            filename=f"reporte_scan.pdf", 
-            media_type="application/pdf"
+    # Con miles de filas el layout de una sola tabla es muy costoso: se
+    # renderiza por lotes y se unen las páginas al final.
+    documentos = []
+    for i in range(0, len(summary), PDF_LOTE_FILAS):
+        tabla = (
+            "<table><thead><tr><th>Severidad</th><th>Nombre</th><th>Detalle / Ruta</th></tr></thead>"
+            f"<tbody>{_filas_html(summary[i:i + PDF_LOTE_FILAS])}</tbody></table>"
         )
+        contenido = (cabecera if i == 0 else "") + tabla
+        documentos.append(HTML(string=PLANTILLA_HTML.format(contenido=contenido)).render())
+    paginas = [pagina for documento in documentos for pagina in documento.pages]
+    return documentos[0].copy(paginas).write_pdf()
+
+def generar_pdf(url: str, summary: list, backend: str) -> bytes:
+    if backend == "html":
+        return renderizar_pdf_html(url, summary)
+    return renderizar_pdf_fpdf(url, summary)
+
+def _pool_pdf() -> ProcessPoolExecutor:
+    global pdf_executor
+    if pdf_executor is None:
+        pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return pdf_executor
+
+def _descartar_pool_pdf(pool: ProcessPoolExecutor):
+    global pdf_executor
+    # Solo si sigue siendo el actual: otra petición pudo haberlo recreado ya
+    if pdf_executor is pool:
+        pdf_executor = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+def detener_pool_pdf():
+    global pdf_executor
+    if pdf_executor is not None:
+        pdf_executor.shutdown(cancel_futures=True)
+        pdf_executor = None
+
+def _guardar_pdf_cache(key: str, data: bytes):
+    global pdf_cache_bytes
+    if len(data) > PDF_CACHE_MAX_BYTES:
+        return
+    pdf_cache[key] = data
+    pdf_cache_bytes += len(data)
+    while pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+        _, antiguo = pdf_cache.popitem(last=False)
+        pdf_cache_bytes -= len(antiguo)
+
+async def obtener_pdf(url: str, summary: list, backend: str, scan_id: int | None = None) -> bytes:
+    if backend not in PDF_BACKENDS:
+        raise HTTPException(status_code=400, detail=f"backend debe ser uno de {list(PDF_BACKENDS)}")
+
+    contenido = json.dumps([url, summary], sort_keys=True, ensure_ascii=False, default=str)
+    key = f"{scan_id or '-'}:{backend}:{hashlib.sha256(contenido.encode()).hexdigest()}"
+    if key in pdf_cache:
+        PDF_CACHE_CONSULTAS.inc(result="hit")
+        pdf_cache.move_to_end(key)
+        return pdf_cache[key]
+    PDF_CACHE_CONSULTAS.inc(result="miss")
 
+    loop = asyncio.get_running_loop()
+    for intento in range(2):
+        pool = _pool_pdf()
+        try:
+            with medir_etapa("pdf_render"):
+                data = await loop.run_in_executor(pool, generar_pdf, url, summary, backend)
+            break
+        except BrokenProcessPool:
+            # Un worker murió (OOM, señal): el pool queda inservible para
+            # siempre, así que se descarta y se reintenta una vez con uno nuevo
+            _descartar_pool_pdf(pool)
+            if intento:
+                raise HTTPException(status_code=500, detail="El proceso de generación del PDF terminó inesperadamente")
+            print("⚠️ Pool de PDF roto, se recrea")
+        except (ImportError, OSError) as e:
+            # WeasyPrint no instalado o sin las librerías de sistema (pango, cairo)
+            raise HTTPException(status_code=501, detail=f"Backend {backend} no disponible: {e}")
+    _guardar_pdf_cache(key, data)
+    return data
+
+def _respuesta_pdf(data: bytes, filename: str) -> StreamingResponse:
+    def trozos():
+        vista = memoryview(data)
+        for i in range(0, len(vista), PDF_TROZO_BYTES):
+            yield vista[i:i + PDF_TROZO_BYTES]
+
+    return StreamingResponse(
+        trozos(),
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Length": str(len(data))
+        }
+    )
+
+@app.post("/scan-pdf")
+async def scan_url_pdf(request: ScanRequest):
+    try:
+        summary = request.vulnerabilities
+
+        if not summary and request.scan_id is not None:
+            # El frontend puede pedir el reporte de un escaneo guardado sin
+            # reenviar los hallazgos
+            summary = (await run_in_threadpool(get_history_scan, request.scan_id))["vulnerabilities"]
+        
+        if not summary:
+            print("⚠️ Advertencia: Lista vacía")
+
+        data = await obtener_pdf(request.url, summary, request.backend, request.scan_id)
+        return _respuesta_pdf(data, "reporte_scan.pdf")
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error generando PDF: {str(e)}")
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@app.get("/history/{scan_id}/pdf")
+async def get_history_pdf(scan_id: int, backend: str = "fpdf"):
+    scan = await run_in_threadpool(get_history_scan, scan_id)
+    data = await obtener_pdf(scan["url"], scan["vulnerabilities"], backend, scan_id)
+    return _respuesta_pdf(data, f"reporte_scan_{scan_id}.pdf")
+
+# --- 6. MÉTRICAS ---
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    contenido = "\n".join(metrica.exponer() for metrica in registro_metricas) + "\n"
+    return PlainTextResponse(contenido, media_type="text/plain; version=0.0.4; charset=utf-8")
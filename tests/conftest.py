@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main.py vive en la raíz del repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# La base de datos de las pruebas no debe ser la del repo
+os.environ.setdefault("DATABASE_FILE", os.path.join(tempfile.mkdtemp(prefix="tests-"), "test.db"))
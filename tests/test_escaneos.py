@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import main
+from conftest import REPO_DIR
+
+FAKE_NUCLEI = os.path.join(REPO_DIR, "benchmarks", "fake_nuclei.py")
+
+
+@pytest.fixture
+def nuclei_falso(monkeypatch, tmp_path):
+    contador = tmp_path / "spawns.txt"
+    monkeypatch.setattr(main, "NUCLEI_PATH", FAKE_NUCLEI)
+    monkeypatch.setenv("FAKE_NUCLEI_FINDINGS", "50")
+    monkeypatch.setenv("FAKE_NUCLEI_DELAY", "0.05")
+    monkeypatch.setenv("FAKE_NUCLEI_MALFORMED", "0")
+    monkeypatch.setenv("FAKE_NUCLEI_COUNTER", str(contador))
+    main.SQLModel.metadata.create_all(main.engine)
+    return contador
+
+
+def _pids(contador) -> list[int]:
+    if not contador.exists():
+        return []
+    return [int(line) for line in contador.read_text().split()]
+
+
+def _vivo(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+async def _stream_y_desconectar(path: str, query: str):
+    # Cliente ASGI mínimo: se desconecta en cuanto recibe el primer hallazgo,
+    # igual que `curl -N ... | head -1`
+    desconectar = asyncio.Event()
+
+    async def receive():
+        await desconectar.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            desconectar.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "headers": [], "root_path": "",
+        "client": ("127.0.0.1", 50000), "server": ("test", 80),
+    }
+    await asyncio.wait_for(main.app(scope, receive, send), timeout=10)
+
+
+def test_desconexion_de_scan_stream_libera_nuclei(nuclei_falso):
+    async def escenario():
+        # Más desconexiones que huecos en el semáforo: si alguno no se
+        # liberara, el escaneo final quedaría esperando para siempre
+        for i in range(main.NUCLEI_MAX_PROCESOS + 1):
+            await _stream_y_desconectar("/scan-stream", f"url=http://corte-{i}.local")
+
+        assert main.NUCLEI_ACTIVOS.valores.get((), 0) == 0
+        findings, _ = await asyncio.wait_for(main.ejecutar_nuclei_async("http://despues.local"), timeout=30)
+        assert len(findings) == 50
+
+        await asyncio.sleep(0.1)
+        pendientes = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        assert pendientes == []
+
+    asyncio.run(escenario())
+
+    pids = _pids(nuclei_falso)
+    assert len(pids) == main.NUCLEI_MAX_PROCESOS + 2
+    limite = time.monotonic() + 5
+    while any(_vivo(pid) for pid in pids) and time.monotonic() < limite:
+        time.sleep(0.05)
+    assert not any(_vivo(pid) for pid in pids)
+
+
+def test_cancelar_al_primero_no_afecta_al_escaneo_compartido(nuclei_falso):
+    async def escenario():
+        primero = asyncio.create_task(main.ejecutar_nuclei_cacheado("http://compartido.local", True))
+        await asyncio.sleep(0.3)
+        primero.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await primero
+        summary, _ = await asyncio.wait_for(
+            main.ejecutar_nuclei_cacheado("http://compartido.local", True), timeout=30
+        )
+        assert len(summary) == 50
+
+    asyncio.run(escenario())
+    assert main.NUCLEI_ACTIVOS.valores.get((), 0) == 0
+
+
+def test_delete_cancela_trabajo_en_curso(nuclei_falso):
+    from fastapi.testclient import TestClient
+
+    def esperar_estado(client, job_id, estados):
+        limite = time.monotonic() + 30
+        while time.monotonic() < limite:
+            job = client.get(f"/scans/{job_id}").json()
+            if job["status"] in estados:
+                return job
+            time.sleep(0.05)
+        raise AssertionError(f"el trabajo {job_id} no llegó a {estados}")
+
+    with TestClient(main.app) as client:
+        job_id = client.post("/scans", json={"url": "http://trabajo.local", "force": True}).json()["job_id"]
+        esperar_estado(client, job_id, {"running"})
+        # Esperar a que nuclei haya arrancado de verdad
+        limite = time.monotonic() + 10
+        while not _pids(nuclei_falso) and time.monotonic() < limite:
+            time.sleep(0.05)
+
+        assert client.delete(f"/scans/{job_id}").json() == {"status": "ok", "job_id": job_id}
+        assert esperar_estado(client, job_id, {"cancelled", "done", "error"})["status"] == "cancelled"
+        assert client.delete(f"/scans/{job_id}").status_code == 409
+        assert client.delete("/scans/999999").status_code == 404
+        assert main.NUCLEI_ACTIVOS.valores.get((), 0) == 0
+
+    limite = time.monotonic() + 5
+    while any(_vivo(pid) for pid in _pids(nuclei_falso)) and time.monotonic() < limite:
+        time.sleep(0.05)
+    assert not any(_vivo(pid) for pid in _pids(nuclei_falso))
+
+
+def test_version_de_nuclei_se_consulta_una_sola_vez(monkeypatch, tmp_path):
+    # Envoltorio que registra cada "-version" y tarda lo suficiente para que
+    # las llamadas en frío se solapen
+    registro = tmp_path / "versiones.txt"
+    envoltorio = tmp_path / "nuclei"
+    envoltorio.write_text(
+        "#!/bin/sh\n"
+        f'case " $* " in *" -version "*) echo x >> "{registro}"; sleep 0.3;; esac\n'
+        f'exec "{FAKE_NUCLEI}" "$@"\n'
+    )
+    envoltorio.chmod(0o755)
+    monkeypatch.setattr(main, "NUCLEI_PATH", str(envoltorio))
+    monkeypatch.setattr(main, "nuclei_version", None)
+
+    async def escenario():
+        return await asyncio.gather(*(main.obtener_version_nuclei() for _ in range(8)))
+
+    versiones = asyncio.run(escenario())
+    assert set(versiones) == {"v3.0.0-fake"}
+    assert registro.read_text().count("x") == 1
@@ -0,0 +1,113 @@
+import textwrap
+
+from main import leer_cabecera_plantilla
+
+
+def _plantilla(tmp_path, contenido: str, nombre: str = "plantilla.yaml") -> str:
+    path = tmp_path / nombre
+    path.write_text(textwrap.dedent(contenido).lstrip(), encoding="utf-8")
+    return str(path)
+
+
+def test_tags_en_linea_y_metadatos_anidados(tmp_path):
+    path = _plantilla(tmp_path, """
+        id: CVE-2021-41773
+
+        info:
+          name: "Apache 2.4.49 - Path Traversal"
+          author: daffainfo,666asd
+          severity: critical
+          description: |
+            tags: esto-no-es-un-tag
+          classification:
+            cve-id: CVE-2021-41773
+          metadata:
+            max-request: 3
+          tags: cve,cve2021,Apache,lfi
+
+        http:
+          - method: GET
+    """)
+    datos = leer_cabecera_plantilla(path)
+    assert datos["id"] == "CVE-2021-41773"
+    assert datos["name"] == "Apache 2.4.49 - Path Traversal"
+    assert datos["severity"] == "critical"
+    assert datos["author"] == "daffainfo,666asd"
+    assert datos["tags"] == ["apache", "cve", "cve2021", "lfi"]
+    assert datos["protocol"] == "http"
+
+
+def test_tags_y_author_en_lista_de_bloque(tmp_path):
+    path = _plantilla(tmp_path, """
+        id: wordpress-detect
+        info:
+          name: WordPress Detect
+          author:
+            - pdteam
+            - geeknik
+          severity: info
+          tags:
+            - tech
+            - wordpress
+        requests:
+          - method: GET
+    """)
+    datos = leer_cabecera_plantilla(path)
+    assert datos["author"] == "pdteam,geeknik"
+    assert datos["tags"] == ["tech", "wordpress"]
+    assert datos["protocol"] == "http"
+
+
+def test_tags_en_lista_flujo_e_info_con_cuatro_espacios(tmp_path):
+    path = _plantilla(tmp_path, """
+        id: dns-misconfig
+        info:
+            name: DNS misconfig
+            author: [alice, bob]
+            severity: medium
+            tags: [dns, misconfig]
+        dns:
+          - name: "{{FQDN}}"
+    """)
+    datos = leer_cabecera_plantilla(path)
+    assert datos["author"] == "alice,bob"
+    assert datos["severity"] == "medium"
+    assert datos["tags"] == ["dns", "misconfig"]
+    assert datos["protocol"] == "dns"
+
+
+def test_flow_no_es_un_protocolo(tmp_path):
+    path = _plantilla(tmp_path, """
+        id: flow-template
+        info:
+          name: Flow
+          severity: low
+          tags: tech
+        flow: http(1) && http(2)
+        http:
+          - method: GET
+    """)
+    assert leer_cabecera_plantilla(path)["protocol"] == "http"
+
+
+def test_workflow_se_descarta(tmp_path):
+    path = _plantilla(tmp_path, """
+        id: wordpress-workflow
+        info:
+          name: WordPress Security Checks
+          author: pdteam
+          severity: critical
+          tags: cve
+
+        workflows:
+          - template: technologies/wordpress-detect.yaml
+    """, "wf.yaml")
+    assert leer_cabecera_plantilla(path) is None
+
+
+def test_archivo_sin_id(tmp_path):
+    path = _plantilla(tmp_path, """
+        info:
+          name: Sin id
+    """)
+    assert leer_cabecera_plantilla(path) is None